@@ -103,11 +103,20 @@ def main_worker_function(rank, ngpus_per_node, is_distributed, config):
     # Instantiate model and engine
     model = instantiate(config.model).to(gpu)
 
+    # Use channels last memory format for the model weights if requested by the engine, before wrapping in DDP
+    if config.engine.get('channels_last', False):
+        model = model.to(memory_format=torch.channels_last)
+
     # Configure the device to be used for model training and inference
     if is_distributed:
         # Convert model batch norms to synchbatchnorm
         model = torch.nn.SyncBatchNorm.convert_sync_batchnorm(model)
-        model = DDP(model, device_ids=[gpu])
+        # Overlap gradient all-reduce with backward using buckets, writing gradients directly into the buckets and
+        # relying on the graph being the same every iteration. These settings can be overridden by a `ddp` config entry.
+        ddp_kwargs = {'bucket_cap_mb': 50, 'gradient_as_bucket_view': True, 'static_graph': True}
+        if 'ddp' in config:
+            ddp_kwargs.update(config.ddp)
+        model = DDP(model, device_ids=[gpu], **ddp_kwargs)
 
     # Instantiate the engine
     engine = instantiate(config.engine, model=model, rank=rank, gpu=gpu, dump_path=config.dump_path)
@@ -25,6 +25,7 @@ import copy
 # WatChMaL imports
 from watchmal.dataset.data_utils import get_data_loader
 from watchmal.utils.logging_utils import CSVData
+from watchmal.engine.prefetch import CUDAPrefetcher, DataPrefetcher
 
 #Zennit imports
 from zennit.attribution import Gradient, SmoothGrad
@@ -39,7 +40,8 @@ from zennit.torchvision import VGGCanonizer, ResNetCanonizer
 
 class ClassifierEngine:
     """Engine for performing training or evaluation  for a classification network."""
-    def __init__(self, model, rank, gpu, dump_path, label_set=None):
+    def __init__(self, model, rank, gpu, dump_path, label_set=None, amp=False, compile_model=False,
+                 channels_last=False):
         """
         Parameters
         ==========
@@ -54,6 +56,16 @@ class ClassifierEngine:
         label_set : sequence
             The set of possible labels to classify (if None, which is the default, then class labels in the data must be
             0 to N).
+        amp : bool
+            Whether to use automatic mixed precision (float16 autocast with gradient scaling) for the forward and
+            backward passes. False by default.
+        compile_model : bool
+            Whether to compile the model with `torch.compile` for the forward pass in training, validation and
+            evaluation. The LRP attribution always uses the uncompiled model. False by default.
+        channels_last : bool
+            Whether to use the channels last (NHWC) memory format for the 4D input data, allowing faster convolution
+            kernels for CNNs. The model weights must already be in channels last format, before any wrapping in
+            DistributedDataParallel. False by default.
         """
         # create the directory for saving the log and dump files
         self.epoch = 0.
@@ -73,6 +85,20 @@ class ClassifierEngine:
             self.is_distributed = False
             self.model_accs = self.model
 
+        # The model weights are converted to channels last memory format before the engine is created, since converting
+        # them after wrapping in DistributedDataParallel would change the layout that its gradient buckets rely on
+        self.channels_last = channels_last
+        if self.channels_last:
+            assert all(p.is_contiguous(memory_format=torch.channels_last) for p in self.model_accs.parameters() if p.dim() == 4), \
+                "Error: channels_last requires the model weights to already be in channels last memory format"
+
+        # Compile the model for the forward pass, specializing on the fixed input shapes, while keeping the original
+        # model for saving and loading state and for the LRP hooks
+        if compile_model:
+            self.compiled_model = torch.compile(self.model, mode="reduce-overhead", fullgraph=False, dynamic=False)
+        else:
+            self.compiled_model = self.model
+
         self.data_loaders = {}
         self.label_set = label_set
 
@@ -89,67 +115,80 @@ class ClassifierEngine:
 
         self.criterion = nn.CrossEntropyLoss()
         self.softmax = nn.Softmax(dim=1)
+
+        # one-hot targets of each class for the LRP attribution
+        self.lrp_targets = torch.eye(4, device=self.device)
+
+        # mixed precision attributes
+        self.amp_enabled = amp
+        self.scaler = torch.amp.GradScaler(self.device.type, enabled=amp)
         
         self.optimizer = None
         self.scheduler = None
 
-    def epsilonAlpha2Beta1(self, model, data):
+        # side stream for copying the next batch to the gpu while the current batch is processed
+        self.copy_stream = torch.cuda.Stream(device=self.device) if self.device.type == 'cuda' else None
+
+    def lrp(self, model, data, composite_class):
+        """
+        Compute the LRP attribution of a batch of data for each of the possible classes.
+
+        Parameters
+        ==========
+        model
+            nn.module object of the network to explain.
+        data : torch.Tensor
+            Batch of input data, on the same device as the model.
+        composite_class
+            Zennit composite class defining the LRP rules, instantiated with the ResNet canonizer.
+
+        Returns
+        =======
+        np.ndarray
+            Model outputs for each target class in turn, of shape (4*batch size, number of classes).
+        np.ndarray
+            Relevance summed over the events of the batch for each target class in turn, of shape
+            (4*channels, *remaining data dimensions).
+        """
         # use the ResNet-specific canonizer
         canonizer = ResNetCanonizer()
         
         # create a composite, specifying the canonizers
-        composite = EpsilonAlpha2Beta1(canonizers=[canonizer])
+        composite = composite_class(canonizers=[canonizer])
         
-        total_output = []
-        total_relevance = []
-        #iterate over all the possible classes
-        for i in range(4):
-            
-            # choose a target class for the attribution
-            initial_target = torch.eye(4)[[i]]
-            target = torch.tile(initial_target, (data.shape[0],1))
-            
-            # create the attributor, specifying model and composite
-            with Gradient(model=model, composite=composite) as attributor:
-                # compute the model output and attribution
-                print(data.shape)
-                output, attribution = attributor(data, target)
-                
-            relevance = attribution.sum(0)
-            total_output.extend(output.detach().cpu().numpy())
-            total_relevance.extend(relevance.detach().cpu().numpy())
+        # repeat each event once per possible class, with the one-hot target of each class
+        batch_size = data.shape[0]
+        all_data = data.repeat_interleave(4, dim=0)
+        all_targets = self.lrp_targets.repeat(batch_size, 1)
         
-        return np.array(total_output), np.array(total_relevance)
-    
-    def epsilonPlusFlat(self, model, data):
-        # use the ResNet-specific canonizer
-        canonizer = ResNetCanonizer()
+        # create the attributor, specifying model and composite
+        with Gradient(model=model, composite=composite) as attributor:
+            # compute the model output and attribution for all classes at once
+            output, attribution = attributor(all_data, all_targets)
         
-        # create a composite, specifying the canonizers
-        composite = EpsilonPlusFlat(canonizers=[canonizer])
+        # order the outputs by target class, and sum the relevance over the events for each class
+        output = output.detach()
+        attribution = attribution.detach()
+        total_output = output.view(batch_size, 4, -1).transpose(0, 1).reshape(4*batch_size, -1).cpu().numpy()
+        total_relevance = attribution.view(batch_size, 4, *data.shape[1:]).sum(0).flatten(0, 1).cpu().numpy()
         
-        total_output = []
-        total_relevance = []
-        #iterate over all the possible classes
-        for i in range(4):
-            
-            # choose a target class for the attribution
-            target = torch.eye(4)[[i]]
-            
-            # create the attributor, specifying model and composite
-            with Gradient(model=model, composite=composite) as attributor:
-                # compute the model output and attribution
-                output, attribution = attributor(data, target)
-            
-            relevance = attribution.sum(0)
-            total_output.extend(output.detach().cpu().numpy())
-            total_relevance.extend(relevance.detach().cpu().numpy())
+        # release the attribution tensors before the next batch
+        del output, attribution
         
-        return np.array(total_output), np.array(total_relevance)
+        return total_output, total_relevance
+
+    def epsilonAlpha2Beta1(self, model, data):
+        return self.lrp(model, data, EpsilonAlpha2Beta1)
+    
+    def epsilonPlusFlat(self, model, data):
+        return self.lrp(model, data, EpsilonPlusFlat)
     
     def configure_optimizers(self, optimizer_config):
-        """Instantiate an optimizer from a hydra config."""
-        self.optimizer = instantiate(optimizer_config, params=self.model_accs.parameters())
+        """
+        Instantiate an optimizer from a hydra config. Config values are converted to plain python containers, so that
+        the optimizer state can be restored from a checkpoint with `weights_only=True`.
+        """
+        self.optimizer = instantiate(optimizer_config, params=self.model_accs.parameters(), _convert_="all")
 
     def configure_scheduler(self, scheduler_config):
         """Instantiate a scheduler from a hydra config."""
@@ -177,28 +216,63 @@ class ClassifierEngine:
             if self.label_set is not None:
                 self.data_loaders[name].dataset.map_labels(self.label_set)
     
-    def get_synchronized_metrics(self, metric_dict):
+    def get_synchronized_outputs(self, output_dict):
         """
-        Gathers metrics from multiple processes using pytorch distributed operations for DistributedDataParallel
+        Gathers arrays from multiple processes using a single pytorch distributed operation, by packing them into one
+        contiguous byte buffer. The arrays can have different dtypes, and their lengths can differ between processes.
 
         Parameters
         ==========
-        metric_dict : dict of torch.Tensor
-            Dictionary containing values that are tensor outputs of a single process.
-        
+        output_dict : dict of array_like
+            Dictionary containing array outputs of a single process. Apart from the length of their first dimension,
+            each array must have the same shape and dtype in all processes.
+
         Returns
         =======
-        global_metric_dict : dict of torch.Tensor
-            Dictionary containing concatenated list of tensor values gathered from all processes
+        global_output_dict : dict of np.ndarray
+            Dictionary containing the arrays from all processes, concatenated along their first dimension. Only the
+            process with rank 0 unpacks the gathered arrays, the dictionary is empty in all other processes.
         """
-        global_metric_dict = {}
-        for name, array in zip(metric_dict.keys(), metric_dict.values()):
-            tensor = torch.as_tensor(array).to(self.device)
-            global_tensor = [torch.zeros_like(tensor).to(self.device) for i in range(self.ngpus)]
-            torch.distributed.all_gather(global_tensor, tensor)
-            global_metric_dict[name] = torch.cat(global_tensor)
-        
-        return global_metric_dict
+        arrays = [np.ascontiguousarray(np.atleast_1d(array)) for array in output_dict.values()]
+        row_nbytes = np.array([array.itemsize*int(np.prod(array.shape[1:])) for array in arrays], dtype=np.int64)
+
+        # gather the length of each array in each process, to know the layout of every packed buffer
+        local_lengths = torch.tensor([array.shape[0] for array in arrays], dtype=torch.int64, device=self.device)
+        lengths = torch.empty(self.ngpus*len(arrays), dtype=torch.int64, device=self.device)
+        torch.distributed.all_gather_into_tensor(lengths, local_lengths)
+        lengths = lengths.view(self.ngpus, len(arrays)).cpu().numpy()
+        max_nbytes = int((lengths*row_nbytes).sum(axis=1).max())
+
+        # pack the local arrays into a byte buffer on the device, padded to the largest buffer of all processes,
+        # copying each array straight into its slice so that no concatenated copy is made on the host
+        buffer = torch.zeros(max_nbytes, dtype=torch.uint8, device=self.device)
+        offset = 0
+        for array in arrays:
+            buffer[offset:offset+array.nbytes].copy_(torch.from_numpy(array.reshape(-1).view(np.uint8)))
+            offset += array.nbytes
+
+        global_buffer = torch.empty(self.ngpus*max_nbytes, dtype=torch.uint8, device=self.device)
+        torch.distributed.all_gather_into_tensor(global_buffer, buffer)
+        del buffer
+
+        # only the process with rank 0 uses the results, so the others do not copy them back to the host
+        if self.rank != 0:
+            return {}
+        global_buffer = global_buffer.view(self.ngpus, max_nbytes).cpu().numpy()
+
+        # unpack the arrays of each process and concatenate them
+        global_output_dict = {}
+        offsets = np.zeros(self.ngpus, dtype=np.int64)
+        for i, (name, array) in enumerate(zip(output_dict.keys(), arrays)):
+            rank_arrays = []
+            for rank in range(self.ngpus):
+                nbytes = lengths[rank, i]*row_nbytes[i]
+                rank_bytes = global_buffer[rank, offsets[rank]:offsets[rank]+nbytes]
+                rank_arrays.append(rank_bytes.view(array.dtype).reshape(-1, *array.shape[1:]))
+                offsets[rank] += nbytes
+            global_output_dict[name] = np.concatenate(rank_arrays)
+
+        return global_output_dict
 
     def forward(self, train=True):
         """
@@ -212,35 +286,50 @@ class ClassifierEngine:
         Returns
         =======
         dict
-            Dictionary containing loss, predicted labels, softmax, accuracy, and raw model outputs
+            Dictionary containing loss, predicted labels, softmax, accuracy, and raw model outputs. The loss and number
+            of correct predictions are also given as tensors on the device, in `loss_t` and `correct_t`. In training mode
+            the python `loss` and `accuracy` values are not included, to avoid synchronizing with the device, and the
+            unused softmax is not computed.
         """
         with torch.set_grad_enabled(train):
             # Move the data and the labels to the GPU (if using CPU this has no effect)
             data = self.data.to(self.device)
             labels = self.labels.to(self.device)
+            if self.channels_last and data.dim() == 4:
+                data = data.contiguous(memory_format=torch.channels_last)
+
+            with torch.autocast(device_type=self.device.type, dtype=torch.float16, enabled=self.amp_enabled):
+                model_out = self.compiled_model(data)
+                self.loss = self.criterion(model_out, labels)
 
-            model_out = self.model(data)
+            # keep the softmax and predictions in full precision
+            model_out = model_out.float()
             
-            softmax = self.softmax(model_out)
             predicted_labels = torch.argmax(model_out, dim=-1)
 
             result = {'predicted_labels': predicted_labels,
-                      'softmax': softmax,
                       'raw_pred_labels': model_out}
 
-            self.loss = self.criterion(model_out, labels)
-            accuracy = (predicted_labels == labels).sum().item() / float(predicted_labels.nelement())
+            if not train:
+                result['softmax'] = self.softmax(model_out)
+
+            correct = (predicted_labels == labels).sum()
 
-            result['loss'] = self.loss.item()
-            result['accuracy'] = accuracy
+            result['loss_t'] = self.loss.detach()
+            result['correct_t'] = correct
+
+            if not train:
+                result['loss'] = self.loss.item()
+                result['accuracy'] = correct.item() / float(predicted_labels.nelement())
         
         return result
     
     def backward(self):
         """Backward pass using the loss computed for a mini-batch"""
-        self.optimizer.zero_grad()  # reset accumulated gradient
-        self.loss.backward()        # compute new gradient
-        self.optimizer.step()       # step params
+        self.optimizer.zero_grad(set_to_none=True)  # reset accumulated gradient
+        self.scaler.scale(self.loss).backward()     # compute new (scaled) gradient
+        self.scaler.step(self.optimizer)            # step params
+        self.scaler.update()                        # update the scale factor for the next iteration
 
     def train(self, train_config):
         """
@@ -258,6 +347,7 @@ class ClassifierEngine:
         num_val_batches     = train_config.num_val_batches
         checkpointing       = train_config.checkpointing
         save_interval = train_config.save_interval if 'save_interval' in train_config else None
+        use_data_prefetch = train_config.use_data_prefetch if 'use_data_prefetch' in train_config else False
 
         # set the iterations at which to dump the events and their metrics
         if self.rank == 0:
@@ -276,69 +366,134 @@ class ClassifierEngine:
         # initialize the iterator over the validation set
         val_iter = iter(self.data_loaders["validation"])
 
-        # global training loop for multiple epochs
-        for self.epoch in range(epochs):
-            if self.rank == 0:
-                print('Epoch', self.epoch+1, 'Starting @', strftime("%Y-%m-%d %H:%M:%S", localtime()))
+        # background data prefetcher of the current epoch, if used
+        data_prefetcher = None
+
+        # metrics of the mini-batches since the last report, kept on the device until they are logged
+        pending_metrics = []
+
+        # global training loop for multiple epochs, making sure the logs are written out even if training fails
+        try:
+            for self.epoch in range(epochs):
+                if self.rank == 0:
+                    print('Epoch', self.epoch+1, 'Starting @', strftime("%Y-%m-%d %H:%M:%S", localtime()))
             
-            times = []
+                times = []
 
-            start_time = time()
-            iteration_time = start_time
+                start_time = time()
+                iteration_time = start_time
 
-            train_loader = self.data_loaders["train"]
-            self.step = 0
-            # update seeding for distributed samplers
-            if self.is_distributed:
-                train_loader.sampler.set_epoch(self.epoch)
+                train_loader = self.data_loaders["train"]
+                self.step = 0
+                # update seeding for distributed samplers
+                if self.is_distributed:
+                    train_loader.sampler.set_epoch(self.epoch)
+
+                # optionally fetch batches from the data loader in a background thread
+                if use_data_prefetch:
+                    data_prefetcher = DataPrefetcher(train_loader)
+                batches = data_prefetcher if use_data_prefetch else train_loader
 
-            # local training loop for batches in a single epoch 
-            for self.step, train_data in enumerate(train_loader):
+                # copy the next batch to the gpu while training on the current batch
+                prefetcher = CUDAPrefetcher(batches, self.device, self.copy_stream)
+                train_data = prefetcher.next()
+
+                # number of steps in the epoch, for reporting
+                n_steps = len(train_loader)
+
+                # local training loop for batches in a single epoch 
+                while train_data is not None:
                 
-                # run validation on given intervals
-                if self.iteration % val_interval == 0:
-                    self.validate(val_iter, num_val_batches, checkpointing)
+                    # run validation on given intervals
+                    if self.iteration % val_interval == 0:
+                        self.validate(val_iter, num_val_batches, checkpointing)
                 
-                # Train on batch
-                self.data = train_data['data']
-                self.labels = train_data['labels']
+                    # Train on batch
+                    self.data = train_data['data']
+                    self.labels = train_data['labels']
 
-                # Call forward: make a prediction & measure the average error using data = self.data
-                res = self.forward(True)
+                    # Call forward: make a prediction & measure the average error using data = self.data
+                    res = self.forward(True)
 
-                #Call backward: backpropagate error and update weights using loss = self.loss
-                self.backward()
+                    #Call backward: backpropagate error and update weights using loss = self.loss
+                    self.backward()
 
-                # update the epoch and iteration
-                # self.epoch += 1. / len(self.data_loaders["train"])
-                self.step += 1
-                self.iteration += 1
-                
-                # get relevant attributes of result for logging
-                train_metrics = {"iteration": self.iteration, "epoch": self.epoch, "loss": res["loss"], "accuracy": res["accuracy"]}
+                    # update the epoch and iteration
+                    # self.epoch += 1. / len(self.data_loaders["train"])
+                    self.step += 1
+                    self.iteration += 1
                 
-                # record the metrics for the mini-batch in the log
-                self.train_log.record(train_metrics)
-                self.train_log.write()
-                self.train_log.flush()
+                    # get relevant attributes of result for logging
+                    pending_metrics.append({"iteration": self.iteration, "epoch": self.epoch, "loss": res["loss_t"],
+                                            "correct": res["correct_t"], "n_events": res["predicted_labels"].nelement()})
                 
-                # print the metrics at given intervals
-                if self.rank == 0 and self.iteration % report_interval == 0:
-                    previous_iteration_time = iteration_time
-                    iteration_time = time()
+                    # record the metrics in the log and print them at given intervals
+                    if self.iteration % report_interval == 0:
+                        train_metrics = self.record_train_metrics(pending_metrics)
+
+                        if self.rank == 0:
+                            previous_iteration_time = iteration_time
+                            iteration_time = time()
+
+                            print("... Iteration %d ... Epoch %d ... Step %d/%d  ... Training Loss %1.3f ... Training Accuracy %1.3f ... Time Elapsed %1.3f ... Iteration Time %1.3f" %
+                                  (self.iteration, self.epoch+1, self.step, n_steps, train_metrics["loss"], train_metrics["accuracy"], iteration_time - start_time, iteration_time - previous_iteration_time))
+
+                    train_data = prefetcher.next()
 
-                    print("... Iteration %d ... Epoch %d ... Step %d/%d  ... Training Loss %1.3f ... Training Accuracy %1.3f ... Time Elapsed %1.3f ... Iteration Time %1.3f" %
-                          (self.iteration, self.epoch+1, self.step, len(train_loader), res["loss"], res["accuracy"], iteration_time - start_time, iteration_time - previous_iteration_time))
+                # record the metrics remaining since the last report
+                if pending_metrics:
+                    self.record_train_metrics(pending_metrics)
             
-            if self.scheduler is not None:
-                self.scheduler.step()
+                if self.scheduler is not None:
+                    self.scheduler.step()
+
+                if (save_interval is not None) and ((self.epoch+1)%save_interval == 0):
+                    self.save_state(name=f'_epoch_{self.epoch+1}')
+        finally:
+            if data_prefetcher is not None:
+                data_prefetcher.close()
+            # record the metrics of the last mini-batches before a failure, without hiding the original exception if
+            # this fails too (e.g. after a CUDA error)
+            if pending_metrics:
+                try:
+                    self.record_train_metrics(pending_metrics)
+                except Exception as e:
+                    print("Failed to record the remaining training metrics:", e)
+            self.train_log.close()
+            if self.rank == 0:
+                self.val_log.close()
 
-            if (save_interval is not None) and ((self.epoch+1)%save_interval == 0):
-                self.save_state(name=f'_epoch_{self.epoch+1}')   
-      
-        self.train_log.close()
-        if self.rank == 0:
-            self.val_log.close()
+    def record_train_metrics(self, pending_metrics):
+        """
+        Record the metrics of a number of training mini-batches in the training log, transferring their values from the
+        device in one go.
+
+        Parameters
+        ==========
+        pending_metrics : list of dict
+            Metrics of each mini-batch, with the loss and number of correct predictions as tensors on the device. The
+            list is emptied once the metrics are recorded.
+
+        Returns
+        =======
+        dict
+            The metrics recorded for the last mini-batch.
+        """
+        losses = torch.stack([m["loss"] for m in pending_metrics]).float()
+        corrects = torch.stack([m["correct"] for m in pending_metrics]).float()
+        losses, corrects = torch.stack([losses, corrects]).cpu().tolist()
+
+        for metrics, loss, correct in zip(pending_metrics, losses, corrects):
+            train_metrics = {"iteration": metrics["iteration"], "epoch": metrics["epoch"], "loss": loss,
+                             "accuracy": correct / float(metrics["n_events"])}
+            self.train_log.record(train_metrics)
+            self.train_log.write()
+
+        # flush once for all the mini-batches, rather than for every line
+        self.train_log.flush()
+
+        pending_metrics.clear()
+        return train_metrics
 
     def validate(self, val_iter, num_val_batches, checkpointing):
         """
@@ -378,20 +533,18 @@ class ClassifierEngine:
         # record the validation stats
         val_metrics["loss"] /= num_val_batches
         val_metrics["accuracy"] /= num_val_batches
-        local_val_metrics = {"loss": np.array([val_metrics["loss"]]), "accuracy": np.array([val_metrics["accuracy"]])}
 
         if self.is_distributed:
-            global_val_metrics = self.get_synchronized_metrics(local_val_metrics)
-            for name, tensor in zip(global_val_metrics.keys(), global_val_metrics.values()):
-                global_val_metrics[name] = np.array(tensor.cpu())
+            # average the scalar metrics over all processes with a single collective
+            metric_buffer = torch.tensor([val_metrics["loss"], val_metrics["accuracy"]], device=self.device)
+            torch.distributed.all_reduce(metric_buffer, op=torch.distributed.ReduceOp.SUM)
+            metric_buffer /= self.ngpus
+            global_val_loss, global_val_accuracy = metric_buffer.tolist()
         else:
-            global_val_metrics = local_val_metrics
+            global_val_loss, global_val_accuracy = val_metrics["loss"], val_metrics["accuracy"]
 
         if self.rank == 0:
             # Save if this is the best model so far
-            global_val_loss = np.mean(global_val_metrics["loss"])
-            global_val_accuracy = np.mean(global_val_metrics["accuracy"])
-
             val_metrics["loss"] = global_val_loss
             val_metrics["accuracy"] = global_val_accuracy
             val_metrics["epoch"] = self.epoch
@@ -413,6 +566,8 @@ class ClassifierEngine:
     def evaluate(self, test_config):
         """Evaluate the performance of the trained model on the test set."""
         print("evaluating in directory: ", self.dirpath)
+        use_data_prefetch = test_config.use_data_prefetch if 'use_data_prefetch' in test_config else False
+        data_prefetcher = None
 
         
         # Variables to output at the end
@@ -421,112 +576,160 @@ class ClassifierEngine:
         eval_iterations = 0
         
         # Iterate over the validation set to calculate val_loss and val_acc
-        with torch.enable_grad():
-            
-            # Set the model to evaluation mode
-            current_model = self.model.eval()
-            
-            # Variables for the confusion matrix
-            loss, accuracy, indices, labels, predictions, softmaxes= [],[],[],[],[],[]
-            
-            # Variables for LRP
-            lrp_output = []
-            relevance = []
+        # Set the model to evaluation mode
+        current_model = self.model.eval()
+        
+        # Number of events and batches this process will evaluate, to preallocate the outputs
+        n_events = len(self.data_loaders["test"].sampler)
+        n_batches = len(self.data_loaders["test"])
+        cursor = 0
+        
+        # Labels, predictions and softmaxes are kept on the gpu and copied to the outputs in chunks of batches of
+        # around 32MB, rather than copying them for every batch
+        chunk_bytes = 32*1024**2
+        chunk_cursor = 0
+        label_chunks, pred_chunks, soft_chunks = [], [], []
+        
+        # LRP relevance is written to a memory-mapped temporary file, since it can be very large
+        relevance_tmp_path = self.dirpath + "relevance_{}.npy.tmp".format(self.rank)
+        
+        # Make sure the temporary relevance file is removed and the prefetch thread is stopped, even if the evaluation
+        # fails
+        try:
+            # optionally fetch batches from the data loader in a background thread
+            if use_data_prefetch:
+                data_prefetcher = DataPrefetcher(self.data_loaders["test"])
+            test_loader = data_prefetcher if use_data_prefetch else self.data_loaders["test"]
+
+            # Extract the event data and label from the DataLoader iterator, copying the next batch to the gpu while
+            # the LRP of the current batch is computed
+            for it, eval_data in enumerate(CUDAPrefetcher(test_loader, self.device, self.copy_stream)):
             
-            # Extract the event data and label from the DataLoader iterator
-            for it, eval_data in enumerate(self.data_loaders["test"]):
-                
                 # load data
                 self.data = eval_data['data']
                 self.labels = eval_data['labels']
 
                 eval_indices = eval_data['indices']
-                
-                # Run the forward procedure and output the result
-                result = self.forward(train=False)
-                
+            
+                # Run the forward procedure and output the result, without any autograd tracking
+                with torch.inference_mode():
+                    result = self.forward(train=False)
+            
                 data = self.data.to(self.device)
 
-                # Conduct the LRP algorithm and add it to the final result
-                lrp_output.extend([[]])
-                relevance.extend([[]])
-                for i in range(4):
-                    #for j in range(self.data.shape[0]):
-                        #print(self.data.shape)
-                        #print(current_model)
-                        #print(i)
-                        #sliced_data = data[j, :, :, :]
-                    lrp_output, attribution = self.epsilonAlpha2Beta1(current_model, data)
-                    lrp_output[eval_iterations].extend(lrp_output)
-                    relevance[eval_iterations].extend(attribution)
+                # Conduct the LRP algorithm (over all classes), which is the only part requiring gradients
+                with torch.enable_grad():
+                    batch_lrp, batch_rel = self.epsilonAlpha2Beta1(current_model, data)
+                batch_indices = eval_indices.numpy()
+                label_chunks.append(self.labels)
+                pred_chunks.append(result['predicted_labels'].detach())
+                soft_chunks.append(result["softmax"].detach())
+            
+                # Allocate the outputs once the shapes are known from the first batch
+                if it == 0:
+                    batch_bytes = sum(t.nelement()*t.element_size() for t in (self.labels, pred_chunks[0], soft_chunks[0]))
+                    chunk_batches = max(1, chunk_bytes // batch_bytes)
+                    indices     = np.empty(n_events, dtype=batch_indices.dtype)
+                    labels      = np.empty(n_events, dtype=np.int64)
+                    predictions = np.empty(n_events, dtype=np.int64)
+                    softmaxes   = np.empty((n_events, *soft_chunks[0].shape[1:]), dtype=np.float32)
+                    lrp_output  = np.empty((4*n_events, *batch_lrp.shape[1:]), dtype=batch_lrp.dtype)
+                    relevance   = np.memmap(relevance_tmp_path, dtype=batch_rel.dtype, mode="w+",
+                                            shape=(n_batches*batch_rel.shape[0], *batch_rel.shape[1:]))
 
                 eval_loss += result['loss']
                 eval_acc  += result['accuracy']
-                
+            
                 # Add the local result to the final result
-                indices.extend(eval_indices.numpy())
-                labels.extend(self.labels.numpy())
-                predictions.extend(result['predicted_labels'].detach().cpu().numpy())
-                softmaxes.extend(result["softmax"].detach().cpu().numpy())
-           
-                print("eval_iteration : " + str(it) + " eval_loss : " + str(result["loss"]) + " eval_accuracy : " + str(result["accuracy"]))
+                batch_size = batch_indices.shape[0]
+                indices[cursor:cursor+batch_size] = batch_indices
+                lrp_output[4*cursor:4*(cursor+batch_size)] = batch_lrp
+                relevance[it*batch_rel.shape[0]:(it+1)*batch_rel.shape[0]] = batch_rel
+                cursor += batch_size
             
-                eval_iterations += 1
+                # Copy the chunk of results kept on the gpu once it is full
+                if len(soft_chunks) == chunk_batches:
+                    labels[chunk_cursor:cursor] = torch.cat(label_chunks).cpu().numpy()
+                    predictions[chunk_cursor:cursor] = torch.cat(pred_chunks).cpu().numpy()
+                    softmaxes[chunk_cursor:cursor] = torch.cat(soft_chunks).cpu().numpy()
+                    label_chunks, pred_chunks, soft_chunks = [], [], []
+                    chunk_cursor = cursor
+       
+                print("eval_iteration : " + str(it) + " eval_loss : " + str(result["loss"]) + " eval_accuracy : " + str(result["accuracy"]))
         
-        # convert arrays to torch tensors
-        print("loss : " + str(eval_loss/eval_iterations) + " accuracy : " + str(eval_acc/eval_iterations))
+                eval_iterations += 1
 
-        iterations = np.array([eval_iterations])
-        loss = np.array([eval_loss])
-        accuracy = np.array([eval_acc])
+            # Copy the last, partially filled, chunk of results kept on the gpu
+            if soft_chunks:
+                labels[chunk_cursor:cursor] = torch.cat(label_chunks).cpu().numpy()
+                predictions[chunk_cursor:cursor] = torch.cat(pred_chunks).cpu().numpy()
+                softmaxes[chunk_cursor:cursor] = torch.cat(soft_chunks).cpu().numpy()
+                label_chunks, pred_chunks, soft_chunks = [], [], []
+
+            # Trim the outputs to the events and batches actually evaluated, in case the loader yielded fewer batches
+            # than its length
+            indices     = indices[:cursor]
+            labels      = labels[:cursor]
+            predictions = predictions[:cursor]
+            softmaxes   = softmaxes[:cursor]
+            lrp_output  = lrp_output[:4*cursor]
+            relevance   = relevance[:eval_iterations*batch_rel.shape[0]]
+
+            # release the cached memory of the LRP activations once all batches are done
+            torch.cuda.empty_cache()
+    
+            # convert arrays to torch tensors
+            print("loss : " + str(eval_loss/eval_iterations) + " accuracy : " + str(eval_acc/eval_iterations))
 
-        local_eval_metrics_dict = {"eval_iterations":iterations, "eval_loss":loss, "eval_acc":accuracy}
-        
-        indices     = np.array(indices)
-        labels      = np.array(labels)
-        predictions = np.array(predictions)
-        softmaxes   = np.array(softmaxes)
-        lrp_output  = np.array(lrp_output)
-        relevance   = np.array(relevance)
+            iterations = np.array([eval_iterations])
+            loss = np.array([eval_loss])
+            accuracy = np.array([eval_acc])
+
+            local_eval_metrics_dict = {"eval_iterations":iterations, "eval_loss":loss, "eval_acc":accuracy}
         
-        local_eval_results_dict = {"indices":indices, "labels":labels, "predictions":predictions, "softmaxes":softmaxes, "lrp_output":lrp_output, "relevance":relevance}
+            local_eval_results_dict = {"indices":indices, "labels":labels, "predictions":predictions, "softmaxes":softmaxes, "lrp_output":lrp_output, "relevance":relevance}
 
-        if self.is_distributed:
-            # Gather results from all processes
-            global_eval_metrics_dict = self.get_synchronized_metrics(local_eval_metrics_dict)
-            global_eval_results_dict = self.get_synchronized_metrics(local_eval_results_dict)
+            if self.is_distributed:
+                # Gather metrics and results from all processes in a single operation
+                global_eval_dict = self.get_synchronized_outputs({**local_eval_metrics_dict, **local_eval_results_dict})
             
-            if self.rank == 0:
-                for name, tensor in zip(global_eval_metrics_dict.keys(), global_eval_metrics_dict.values()):
-                    local_eval_metrics_dict[name] = np.array(tensor.cpu())
+                if self.rank == 0:
+                    for name in local_eval_metrics_dict.keys():
+                        local_eval_metrics_dict[name] = global_eval_dict[name]
                 
-                indices     = np.array(global_eval_results_dict["indices"].cpu())
-                labels      = np.array(global_eval_results_dict["labels"].cpu())
-                predictions = np.array(global_eval_results_dict["predictions"].cpu())
-                softmaxes   = np.array(global_eval_results_dict["softmaxes"].cpu())
-                lrp_output  = np.array(global_eval_results_dict["lrp_output"].cpu())
-                relevance   = np.array(global_eval_results_dict["relevance"].cpu())
+                    indices     = global_eval_dict["indices"]
+                    labels      = global_eval_dict["labels"]
+                    predictions = global_eval_dict["predictions"]
+                    softmaxes   = global_eval_dict["softmaxes"]
+                    lrp_output  = global_eval_dict["lrp_output"]
+                    relevance   = global_eval_dict["relevance"]
         
-        if self.rank == 0:
-#            print("Sorting Outputs...")
-#            sorted_indices = np.argsort(indices)
-
-            # Save overall evaluation results
-            print("Saving Data...")
-            np.save(self.dirpath + "indices.npy", indices)#sorted_indices)
-            np.save(self.dirpath + "labels.npy", labels)#[sorted_indices])
-            np.save(self.dirpath + "predictions.npy", predictions)#[sorted_indices])
-            np.save(self.dirpath + "softmax.npy", softmaxes)#[sorted_indices])
-            np.save(self.dirpath + "lrp_output.npy", lrp_output)
-            np.save(self.dirpath + "relevance.npy", relevance)
-
-            # Compute overall evaluation metrics
-            val_iterations = np.sum(local_eval_metrics_dict["eval_iterations"])
-            val_loss = np.sum(local_eval_metrics_dict["eval_loss"])
-            val_acc = np.sum(local_eval_metrics_dict["eval_acc"])
-
-            print("\nAvg eval loss : " + str(val_loss/val_iterations),
-                  "\nAvg eval acc : "  + str(val_acc/val_iterations))
+            if self.rank == 0:
+    #            print("Sorting Outputs...")
+    #            sorted_indices = np.argsort(indices)
+
+                # Save overall evaluation results
+                print("Saving Data...")
+                np.save(self.dirpath + "indices.npy", indices)#sorted_indices)
+                np.save(self.dirpath + "labels.npy", labels)#[sorted_indices])
+                np.save(self.dirpath + "predictions.npy", predictions)#[sorted_indices])
+                np.save(self.dirpath + "softmax.npy", softmaxes)#[sorted_indices])
+                np.save(self.dirpath + "lrp_output.npy", lrp_output)
+                np.save(self.dirpath + "relevance.npy", relevance)
+
+                # Compute overall evaluation metrics
+                val_iterations = np.sum(local_eval_metrics_dict["eval_iterations"])
+                val_loss = np.sum(local_eval_metrics_dict["eval_loss"])
+                val_acc = np.sum(local_eval_metrics_dict["eval_acc"])
+
+                print("\nAvg eval loss : " + str(val_loss/val_iterations),
+                      "\nAvg eval acc : "  + str(val_acc/val_iterations))
+        finally:
+            if data_prefetcher is not None:
+                data_prefetcher.close()
+            relevance = local_eval_results_dict = None
+            if os.path.exists(relevance_tmp_path):
+                os.remove(relevance_tmp_path)
         
     # ========================================================================
     # Saving and loading models
@@ -556,11 +759,13 @@ class ClassifierEngine:
         # Save parameters
         # 0+1) iteration counter + optimizer state => in case we want to "continue training" later
         # 2) network weight
+        # 3) mixed precision gradient scaler state => so the loss scale continues from where it was
         torch.save({
             'global_step': self.iteration,
             'optimizer': self.optimizer.state_dict(),
-            'state_dict': model_dict
-        }, filename)
+            'state_dict': model_dict,
+            'scaler': self.scaler.state_dict()
+        }, filename, _use_new_zipfile_serialization=True)
         print('Saved checkpoint as:', filename)
         return filename
 
@@ -579,21 +784,24 @@ class ClassifierEngine:
 
     def restore_state_from_file(self, weight_file):
         """Restore model and training state from a given filename."""
-        # Open a file in read-binary mode
-        with open(weight_file, 'rb') as f:
-            print('Restoring state from', weight_file)
+        print('Restoring state from', weight_file)
 
-            # torch interprets the file, then we can access using string keys
-            checkpoint = torch.load(f)
-            
-            # load network weights
-            self.model_accs.load_state_dict(checkpoint['state_dict'])
-            
-            # if optim is provided, load the state of the optim
-            if self.optimizer is not None:
-                self.optimizer.load_state_dict(checkpoint['optimizer'])
-            
-            # load iteration count
-            self.iteration = checkpoint['global_step']
+        # torch interprets the file, memory-mapping it from the path rather than reading it all into memory first,
+        # then we can access using string keys
+        checkpoint = torch.load(weight_file, map_location=self.device, mmap=True, weights_only=True)
+        
+        # load network weights
+        self.model_accs.load_state_dict(checkpoint['state_dict'])
+        
+        # if optim is provided, load the state of the optim
+        if self.optimizer is not None:
+            self.optimizer.load_state_dict(checkpoint['optimizer'])
+        
+        # load the state of the gradient scaler, if it was saved (it is empty if saved without mixed precision)
+        if checkpoint.get('scaler'):
+            self.scaler.load_state_dict(checkpoint['scaler'])
+        
+        # load iteration count
+        self.iteration = checkpoint['global_step']
         
         print('Restoration complete.')
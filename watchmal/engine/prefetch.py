@@ -0,0 +1,133 @@
+"""
+Utilities for prefetching batches from a data loader so that data loading overlaps with training
+"""
+
+# torch imports
+import torch
+
+# generic imports
+from contextlib import nullcontext
+from queue import Queue, Full
+import threading
+
+
+class CUDAPrefetcher:
+    """
+    Wraps a data loader to copy the data and labels of the next batch to the GPU on a side CUDA stream, while the
+    current batch is being processed on the default stream. On a non-CUDA device the copy is done synchronously.
+    """
+    def __init__(self, loader, device, stream=None):
+        """
+        Parameters
+        ==========
+        loader : iterable
+            Data loader (or other iterable) returning dictionaries with 'data' and 'labels' tensors.
+        device : torch.device
+            The device to copy the batches to.
+        stream : torch.cuda.Stream
+            The side stream to perform the copies on. By default, a new stream is created for a CUDA device.
+        """
+        self.loader = iter(loader)
+        self.device = device
+        if stream is None and device.type == 'cuda':
+            stream = torch.cuda.Stream(device=device)
+        self.stream = stream
+        self.next_batch = None
+        self.preload()
+
+    def preload(self):
+        """Fetch the next batch from the loader and start copying its data and labels to the device."""
+        try:
+            batch = next(self.loader)
+        except StopIteration:
+            self.next_batch = None
+            return
+        with torch.cuda.stream(self.stream) if self.stream is not None else nullcontext():
+            batch['data'] = batch['data'].to(self.device, non_blocking=True)
+            batch['labels'] = batch['labels'].to(self.device, non_blocking=True)
+        self.next_batch = batch
+
+    def next(self):
+        """
+        Return the batch that was preloaded, once its copy is complete, and start preloading the following batch.
+
+        Returns
+        =======
+        dict
+            The next batch with data and labels on the device, or None when the loader is exhausted.
+        """
+        batch = self.next_batch
+        if batch is None:
+            return None
+        if self.stream is not None:
+            current_stream = torch.cuda.current_stream(self.device)
+            current_stream.wait_stream(self.stream)
+            # make sure the caching allocator does not reuse the memory while the current stream is still using it
+            batch['data'].record_stream(current_stream)
+            batch['labels'].record_stream(current_stream)
+        self.preload()
+        return batch
+
+    def __iter__(self):
+        batch = self.next()
+        while batch is not None:
+            yield batch
+            batch = self.next()
+
+
+class DataPrefetcher:
+    """
+    Wraps a data loader to fetch batches in a background thread, keeping a bounded queue of batches ready so that the
+    collation of the next batch on the CPU overlaps with the processing of the current batch.
+    """
+    _end = object()
+
+    def __init__(self, loader, max_prefetch=2):
+        """
+        Parameters
+        ==========
+        loader : iterable
+            Data loader (or other iterable) to fetch batches from.
+        max_prefetch : int
+            Maximum number of batches to hold in the queue.
+        """
+        self.queue = Queue(maxsize=max_prefetch)
+        self.loader = loader
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        """Push batches from the loader into the queue, followed by the end sentinel (or any raised exception)."""
+        try:
+            for batch in self.loader:
+                if not self._put(batch):
+                    return
+        except BaseException as e:
+            self._put(e)
+        finally:
+            self._put(self._end)
+
+    def _put(self, item):
+        """Put an item into the queue, waiting for space until the prefetcher is closed. Returns whether it was put."""
+        while not self.stop_event.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except Full:
+                pass
+        return False
+
+    def close(self):
+        """Stop the background thread, releasing its iterator over the data loader."""
+        self.stop_event.set()
+        self.thread.join()
+
+    def __iter__(self):
+        while True:
+            batch = self.queue.get()
+            if batch is self._end:
+                return
+            if isinstance(batch, BaseException):
+                raise batch
+            yield batch